@@ -1,18 +1,35 @@
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Callable
 from tkinter import Event
-from io import BytesIO
 from math import floor
+from threading import Thread
+from operator import attrgetter
 from tkinter import Menu
 from typing import Any
 
 import cv2
 import customtkinter as ctk
 import numpy
-import requests
 from PIL import Image
 
-from emulators import Emulators
+from emulators import SESSION, Emulators
+
+# icon for games without one (never modified, the hover and badge steps create new images)
+_DEFAULT_ICON = Image.new('RGBA', (150, 150), 'white')
+_big_font: ctk.CTkFont | None = None
+
+
+def big_font() -> ctk.CTkFont:
+    """
+    Font shared by all widgets that use large text
+    Can only be called once the tkinter root window exists
+    :return: the size 20 font
+    """
+    global _big_font
+    if _big_font is None:
+        _big_font = ctk.CTkFont(size=20)
+    return _big_font
 
 
 class WrappingFrame(ctk.CTkFrame):
@@ -25,7 +42,20 @@ class WrappingFrame(ctk.CTkFrame):
         """
         super().__init__(master)
         self.games = []
-        self.bind('<Configure>', self.__reconfigure)
+        self._last_x_size = None
+        self._reconfigure_job = None
+        self.bind('<Configure>', self.__schedule_reconfigure)
+
+    def __schedule_reconfigure(self, _event: Event = None) -> None:
+        """
+        schedules a recalculation of the game positions, replacing any pending one
+        so that a burst of resize events only causes a single recalculation
+        :param _event: Purely for binding to tkinter event. Should not be set to anything.
+        :return: None
+        """
+        if self._reconfigure_job is not None:
+            self.after_cancel(self._reconfigure_job)
+        self._reconfigure_job = self.after(30, self.__reconfigure)
 
     def __reconfigure(self, _event: Event = None) -> None:
         """
@@ -33,12 +63,16 @@ class WrappingFrame(ctk.CTkFrame):
         :param _event: Purely for binding to tkinter event. Should not be set to anything.
         :return: None
         """
+        self._reconfigure_job = None
         # calculate the amount of games that fit on one line
         # (assume that the games are 150px wide with 10px padding)
         # and arrange them in a grid based on that
-        x_size: int = self._current_width // 170
-        if x_size == 0:
-            x_size = 1
+        x_size: int = max(1, self._current_width // 170)
+        # the games only need to be moved if the amount that fits on one line changed
+        if x_size == self._last_x_size:
+            return
+        self._last_x_size = x_size
+        # tkinter only arranges the grid when idle, so this is a single layout pass for all games
         for i in range(len(self.games)):
             self.games[i].grid(row=floor(i / x_size), column=int(i % x_size), padx=10, pady=10)
 
@@ -47,56 +81,142 @@ class WrappingFrame(ctk.CTkFrame):
         Removes all game objects from the frame
         :return: None
         """
+        # drop the icons as well, so they are freed even if something still refers to a game
+        for game in self.games:
+            game.img = game.hover_img = None
         self.games = []
+        self._last_x_size = None
+
+    def destroy(self) -> None:
+        """
+        Cancels any pending recalculation and destroys the frame
+        :return: None
+        """
+        if self._reconfigure_job is not None:
+            self.after_cancel(self._reconfigure_job)
+            self._reconfigure_job = None
+        super().destroy()
 
     def sort(self) -> None:
         """
-        Sorts game objects alphabetically
+        Sorts game objects alphabetically (case-insensitive)
         :return: None
         """
-        self.games.sort(key = lambda g: g.name)
+        self.games.sort(key=attrgetter('sort_key'))
+        # the order changed, so the games have to be moved on the next recalculation
+        self._last_x_size = None
 
 
 class Game(ctk.CTkFrame):
-    def __init__(self, master: WrappingFrame, name: str, emulator: Emulators.Emulator):
+    def __init__(self, master: WrappingFrame, name: str, emulator: Emulators.Emulator,
+                 images: tuple[Image.Image, Image.Image] = None):
         """
         Frame object for displaying and running a game
         :param master: master tkinter widget
         :param name: game name
         :param emulator: emulator that is used to run this game
+        :param images: (icon, hover icon) as returned by Game.prepare_images (prepared here if not given)
         """
         super().__init__(master, border_width=2)
         master.games.append(self)
         self.name = name
+        self.sort_key = name.casefold()
         self.emulator = emulator
         self.path = os.path.abspath(f'{emulator.id}/{name}/game.{emulator.ext}')
 
-        # load the game icon from its directory (default to fully white image)
-        img_path = os.path.join(emulator.id, name, 'icon.png')
-        if not os.path.isfile(img_path):
-            self.img = Image.new('RGBA', (1, 1), 'white')
-        else:
-            self.img = Image.open(img_path).resize((150, 150))
-
-        # create extra image to be used when mouse is hovering over the game
-        self.hover_img = Image.fromarray(cv2.convertScaleAbs(numpy.array(self.img), alpha=0.5, beta=0))
-        # add the emulator icon to the corner of both images
-        self.img.paste(self.emulator.icon, box=(110, 110), mask=self.emulator.icon)
-        self.hover_img.paste(self.emulator.icon, box=(110, 110), mask=self.emulator.icon)
-        self.img = ctk.CTkImage(self.img, size=(150, 150))
-        self.hover_img = ctk.CTkImage(self.hover_img, size=(150, 150))
+        if images is None:
+            images = self.prepare_images(name, emulator)
+        self.img = ctk.CTkImage(images[0], size=(150, 150))
+        self.hover_img = ctk.CTkImage(images[1], size=(150, 150))
 
         self.icon = ctk.CTkLabel(self, image=self.img, text='')
-        self.title = ctk.CTkLabel(self, text=self.name, width=150, wraplength=150, font=ctk.CTkFont(size=20))
+        self.title = ctk.CTkLabel(self, text=self.name, width=150, wraplength=150, font=big_font())
         self.icon.grid(row=0, column=0)
         self.title.grid(row=1, column=0)
 
         # bind hover and click actions for darkening the image and running the game to all relevant objects
         for o in self, self.icon, self.title:
-            o.bind('<Button-1>', lambda e: self.icon.configure(image=self.img))
+            o.bind('<Button-1>', self.show_img)
             o.bind('<ButtonRelease-1>', self.run)
-            o.bind('<Enter>', lambda e: self.icon.configure(image=self.hover_img))
-            o.bind('<Leave>', lambda e: self.icon.configure(image=self.img))
+            o.bind('<Enter>', self.show_hover_img)
+            o.bind('<Leave>', self.show_img)
+
+    @staticmethod
+    def prepare_images(name: str, emulator: Emulators.Emulator) -> tuple[Image.Image, Image.Image]:
+        """
+        Loads the icon of a game and creates its hover version
+        Does not touch tkinter, so it is safe to call from a worker thread
+        :param name: game name
+        :param emulator: emulator that is used to run the game
+        :return: tuple of (icon, hover icon) PIL images with the emulator icon in the corner
+        """
+        # load the game icon from its directory (default to fully white image)
+        img_path = os.path.join(emulator.id, name, 'icon.png')
+        thumb_path = os.path.join(emulator.id, name, '.icon_thumb.png')
+        hover_path = os.path.join(emulator.id, name, '.icon_hover.png')
+        has_icon = os.path.isfile(img_path)
+        if not has_icon:
+            img = _DEFAULT_ICON
+        else:
+            # reuse the processed icons from a previous launch if neither the game icon nor the emulator icon changed
+            source_mtime = max(os.path.getmtime(img_path), os.path.getmtime(emulator.icon_path))
+            try:
+                if min(os.path.getmtime(thumb_path), os.path.getmtime(hover_path)) >= source_mtime:
+                    img, hover_img = Image.open(thumb_path), Image.open(hover_path)
+                    img.load()
+                    hover_img.load()
+                    return img, hover_img
+            except OSError:
+                pass
+            img = Game.load_icon(img_path)
+
+        # create extra image to be used when mouse is hovering over the game
+        # and add the emulator icon to the corner of both images
+        hover_img = Image.alpha_composite(Game.darken(img), emulator.badge_layer)
+        img = Image.alpha_composite(img, emulator.badge_layer)
+
+        if has_icon:
+            # save the processed icons so the next launch can skip all of the above
+            try:
+                img.save(thumb_path, 'PNG', compress_level=1)
+                hover_img.save(hover_path, 'PNG', compress_level=1)
+            except OSError as e:
+                print('Could not save icon thumbnails')
+                print(e)
+        return img, hover_img
+
+    @staticmethod
+    def darken(img: Image.Image) -> Image.Image:
+        """
+        Halves the brightness of the colour channels of an image, leaving alpha untouched
+        Works on the whole pixel array at once, per-pixel steps should be written the same way
+        :param img: RGBA image to darken (not modified)
+        :return: the darkened RGBA image
+        """
+        arr = numpy.array(img)
+        arr[..., :3] >>= 1
+        return Image.fromarray(arr, 'RGBA')
+
+    @staticmethod
+    def load_icon(img_path: str) -> Image.Image:
+        """
+        Loads an icon and scales it down to 150x150 using OpenCV (falls back to PIL if OpenCV can not read it)
+        :param img_path: path of the icon
+        :return: the scaled icon as an RGBA PIL image
+        """
+        # read the whole file at once and let OpenCV decode it from memory
+        arr = cv2.imdecode(numpy.fromfile(img_path, dtype=numpy.uint8), cv2.IMREAD_UNCHANGED)
+        if arr is None or arr.dtype != numpy.uint8:
+            return Image.open(img_path).convert('RGBA').resize((150, 150))
+        arr = cv2.resize(arr, (150, 150), interpolation=cv2.INTER_AREA)
+        # OpenCV uses BGR(A) channel order, PIL expects RGBA
+        if arr.ndim == 2:
+            conversion = cv2.COLOR_GRAY2RGBA
+        elif arr.shape[2] == 3:
+            conversion = cv2.COLOR_BGR2RGBA
+        else:
+            conversion = cv2.COLOR_BGRA2RGBA
+        return Image.fromarray(cv2.cvtColor(arr, conversion), 'RGBA')
 
     def run(self, _event: Event = None) -> None:
         """
@@ -104,9 +224,25 @@ class Game(ctk.CTkFrame):
         :param _event: Purely for binding to tkinter event. Should not be set to anything.
         :return: None
         """
-        self.icon.configure(image=self.hover_img)
+        self.show_hover_img()
         self.emulator.run_game(self)
 
+    def show_img(self, _event: Event = None) -> None:
+        """
+        Shows the normal game icon
+        :param _event: Purely for binding to tkinter event. Should not be set to anything.
+        :return: None
+        """
+        self.icon.configure(image=self.img)
+
+    def show_hover_img(self, _event: Event = None) -> None:
+        """
+        Shows the darkened game icon
+        :param _event: Purely for binding to tkinter event. Should not be set to anything.
+        :return: None
+        """
+        self.icon.configure(image=self.hover_img)
+
 
 class AddGame(ctk.CTkToplevel):
     def __init__(self, master: ctk.CTk, reload_games: Callable):
@@ -118,7 +254,7 @@ class AddGame(ctk.CTkToplevel):
         super().__init__(master)
         self.reload_games = reload_games
         self.title('Add Game')
-        self.font = ctk.CTkFont(size=20)
+        self.font = big_font()
         self.file_label = ctk.CTkLabel(self, text='File:', font=self.font)
         self.file_input = ctk.CTkComboBox(self, values=self.game_choice(), font=self.font,
                                           dropdown_font=self.font, state='readonly')
@@ -161,16 +297,28 @@ class AddGame(ctk.CTkToplevel):
         # create a directory for the game and put the game file in there
         os.mkdir(os.path.join(emu.id, name))
         os.rename(f'roms/{file}', os.path.join(emu.id, name, f'game.{ext}'))
-        # download the icon from the inputted URL and save it into the game directory
+        # download the icon in the background and close this window right away
         icon_path = os.path.join(emu.id, name, 'icon.png')
+        Thread(target=self.fetch_icon, args=(self.icon_input.get(), icon_path), daemon=True).start()
+        self.withdraw()
+
+    def fetch_icon(self, url: str, icon_path: str) -> None:
+        """
+        Downloads an icon and saves it, then reloads the games on the tkinter thread
+        Blocks on the download, so it should be run outside the tkinter thread
+        :param url: URL of the icon
+        :param icon_path: path to save the icon to
+        :return: None
+        """
         try:
-            Image.open(BytesIO(requests.get(self.icon_input.get()).content)).save(icon_path)
+            with SESSION.get(url, stream=True, timeout=10) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                Image.open(response.raw).save(icon_path)
         except Exception as e:
             print('Could not load icon')
             print(e)
-        # close this window
-        self.reload_games()
-        self.withdraw()
+        self.after(0, self.reload_games)
 
 
 class EmuOutdated(ctk.CTkToplevel):
@@ -182,7 +330,7 @@ class EmuOutdated(ctk.CTkToplevel):
         """
         super().__init__(master)
         self.title('Emulator outdated!')
-        self.font = ctk.CTkFont(size=20)
+        self.font = big_font()
 
         self.labels = []
         for i in range(len(outdated)):
@@ -212,22 +360,31 @@ class App(ctk.CTk):
         self.menu.add_command(label='Add Game', command=lambda: AddGame(self, self.load_games))
         self.menu.add_command(label='Open Dolphin', command=lambda: os.system(os.path.abspath('dolphin/dolphin')))
 
-        self.check_emu_versions()
+        # check the emulator versions in the background once the main loop is running,
+        # so the window does not have to wait for GitHub
+        self.after(0, lambda: Thread(target=self.check_emu_versions, daemon=True).start())
         self.mainloop()
 
     def check_emu_versions(self) -> None:
         """
         Checks if any of the emulators are outdated
+        Blocks on network requests, so it should be run outside the tkinter thread
         :return: None
         """
-        outdated = []
-        for emu in Emulators.ALL:
-            vers = emu.installed_version(), emu.latest_version(), emu
-            if vers[0] != vers[1]:
-                outdated.append(vers)
+        # check all emulators at the same time so that the GitHub requests overlap
+        with ThreadPoolExecutor(max_workers=len(Emulators.ALL)) as executor:
+            outdated = [vers for vers in executor.map(self.emu_versions, Emulators.ALL) if vers[0] != vers[1]]
         if outdated:
-            EmuOutdated(self, outdated)
+            # windows have to be created on the tkinter thread
+            self.after(0, lambda: EmuOutdated(self, outdated))
 
+    @staticmethod
+    def emu_versions(emu: Emulators.Emulator) -> tuple[str, str, Emulators.Emulator]:
+        """
+        :param emu: emulator to check
+        :return: tuple of (installed_ver, latest_ver, emulator)
+        """
+        return emu.installed_version(), emu.latest_version(), emu
 
     def load_games(self) -> None:
         """
@@ -236,12 +393,18 @@ class App(ctk.CTk):
         """
         if self.games_frame is not None:
             self.games_frame.destroy()
-            del self.games_frame
+            self.games_frame.clear()
         self.games_frame = WrappingFrame(self)
         self.games_frame.clear()
-        for emu in Emulators.ALL:
-            for game in self.listdir(emu.id):
-                Game(self.games_frame, game, emu)
+        # prepare the game icons in parallel, but create the widgets on the tkinter thread
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = {executor.submit(Game.prepare_images, game, emu): (game, emu)
+                       for emu in Emulators.ALL for game in self.listdir(emu.id)}
+            for future in as_completed(futures):
+                game, emu = futures[future]
+                Game(self.games_frame, game, emu, future.result())
+        # the games are not gridded individually, the frame places all of them in one pass
+        # once it is configured with its actual width
         self.games_frame.sort()
         self.games_frame.grid(sticky='nsew')
 
@@ -250,12 +413,13 @@ class App(ctk.CTk):
         """
         :param dir_name: directory to list
         :param app_name: name of the application in the directory (defaults to dir_name)
-        :return: all files in the directory except the application and its relevant subdirectories
+        :return: all subdirectories of the directory except the ones belonging to the application
         """
         if app_name is None:
             app_name = dir_name
-        return [d for d in os.listdir(dir_name) if d not in
-                (app_name, app_name + '.config', app_name + '.home', app_name + '.png', '.gitignore')]
+        excluded = frozenset((app_name, app_name + '.config', app_name + '.home', app_name + '.png'))
+        with os.scandir(dir_name) as entries:
+            return [e.name for e in entries if e.is_dir() and e.name not in excluded]
 
 
 if __name__ == '__main__':
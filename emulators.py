@@ -1,8 +1,72 @@
+import json
 import os
+import subprocess
 from os import path, system
+from threading import Lock
+from time import time
+from typing import Callable
 
 import requests
 from PIL import Image
+from requests.adapters import HTTPAdapter
+
+VERSION_CACHE_PATH = '_version_cache.json'
+VERSION_CACHE_MAX_AGE = 60 * 60  # seconds before the latest version is revalidated with GitHub
+INSTALLED_CACHE_PATH = '_installed_cache.json'
+_cache_lock = Lock()
+
+# shared session so that connections (and their TLS handshakes) are reused between requests
+SESSION = requests.Session()
+SESSION.headers.update({'User-Agent': 'EvanFox06'})
+SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+
+def _load_cache(cache_path: str) -> dict:
+    """
+    :param cache_path: path of the json cache file
+    :return: the contents of the cache (empty if it does not exist or is unreadable)
+    """
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _update_cache(cache_path: str, key: str, entry: dict) -> None:
+    """
+    Stores a single entry in a json cache file
+    :param cache_path: path of the json cache file
+    :param key: key of the entry
+    :param entry: value of the entry
+    :return: None
+    """
+    with _cache_lock:
+        cache = _load_cache(cache_path)
+        cache[key] = entry
+        with open(cache_path, 'w') as f:
+            json.dump(cache, f)
+
+
+def _binary_version(binary: str, arg: str, parse: Callable[[str], str]) -> str:
+    """
+    Gets the version of an emulator binary from its output
+    Cached in INSTALLED_CACHE_PATH until the binary changes
+    :param binary: path of the emulator binary
+    :param arg: command line argument that makes the binary print its version
+    :param parse: function that extracts the version from the output
+    :return: the version of the binary
+    """
+    binary = path.abspath(binary)
+    st = os.stat(binary)
+    with _cache_lock:
+        entry = _load_cache(INSTALLED_CACHE_PATH).get(binary)
+    if entry is not None and entry['mtime'] == st.st_mtime and entry['size'] == st.st_size:
+        return entry['version']
+
+    version = parse(subprocess.run([binary, arg], capture_output=True, text=True, timeout=5).stdout)
+    _update_cache(INSTALLED_CACHE_PATH, binary, {'mtime': st.st_mtime, 'size': st.st_size, 'version': version})
+    return version
 
 
 class Emulators:
@@ -20,7 +84,12 @@ class Emulators:
             self.id = sid
             self.ext = ext
             self.gh_path = gh_path
-            self.icon = Image.open(f'{sid}/{sid}.png').resize((40, 40))
+            self.icon_path = f'{sid}/{sid}.png'
+            self.icon = Image.open(self.icon_path).resize((40, 40))
+            # transparent game-icon-sized layer with the emulator icon in the corner,
+            # composited onto every game icon of this emulator
+            self.badge_layer = Image.new('RGBA', (150, 150))
+            self.badge_layer.paste(self.icon.convert('RGBA'), box=(110, 110))
 
         @staticmethod
         def get_run_cmd(game) -> str:
@@ -48,13 +117,32 @@ class Emulators:
 
         def latest_version(self) -> str:
             """
+            Cached in VERSION_CACHE_PATH and revalidated with GitHub (using the ETag) once the cache is too old
             :return: the latest version of this emulator from GitHub
             """
-            return requests.get(f'https://api.github.com/repos/{self.gh_path}/releases/latest', headers={
+            with _cache_lock:
+                entry = _load_cache(VERSION_CACHE_PATH).get(self.gh_path)
+            if entry is not None and time() - entry['fetched_at'] < VERSION_CACHE_MAX_AGE:
+                return entry['tag_name']
+
+            headers = {
                 'Accept': 'application/vnd.github+json',
-                'X-GitHub-Api-Version': '2022-11-28',
-                'User-Agent': 'EvanFox06'
-            }).json()['tag_name']
+                'X-GitHub-Api-Version': '2022-11-28'
+            }
+            if entry is not None and entry['etag'] is not None:
+                headers['If-None-Match'] = entry['etag']
+            response = SESSION.get(f'https://api.github.com/repos/{self.gh_path}/releases/latest', headers=headers)
+            if entry is not None and response.status_code == 304:
+                # release did not change since the last request
+                entry['fetched_at'] = time()
+            else:
+                entry = {
+                    'etag': response.headers.get('ETag'),
+                    'tag_name': response.json()['tag_name'],
+                    'fetched_at': time()
+                }
+            _update_cache(VERSION_CACHE_PATH, self.gh_path, entry)
+            return entry['tag_name']
 
     class __Mgba(Emulator):
         def __init__(self):
@@ -66,8 +154,7 @@ class Emulators:
 
         @staticmethod
         def installed_version():
-            v_out = os.popen(f'{path.abspath('mgba/mgba')} --version').read()
-            return v_out.split()[1]
+            return _binary_version('mgba/mgba', '--version', lambda v_out: v_out.split()[1])
 
 
     class __Dolphin(Emulator):
@@ -95,8 +182,7 @@ class Emulators:
 
         @staticmethod
         def installed_version():
-            v_out = os.popen(f'{path.abspath('melonds/melonds')} --help').read()
-            return v_out.split('\n')[0].split()[1]
+            return _binary_version('melonds/melonds', '--help', lambda v_out: v_out.split('\n')[0].split()[1])
 
     class __Azahar(Emulator):
         def __init__(self):
@@ -108,15 +194,15 @@ class Emulators:
 
         @staticmethod
         def installed_version():
-            v_out = os.popen(f'{path.abspath('azahar/azahar')} -v').read()
-            return v_out.split()[1]
+            return _binary_version('azahar/azahar', '-v', lambda v_out: v_out.split()[1])
 
     MGBA = __Mgba()
     DOLPHIN = __Dolphin()
     MELONDS = __MelonDS()
     AZAHAR = __Azahar()
 
-    ALL: list[Emulator] = [MGBA, DOLPHIN, MELONDS, AZAHAR]
+    ALL: tuple[Emulator, ...] = (MGBA, DOLPHIN, MELONDS, AZAHAR)
+    _BY_EXT: dict[str, Emulator] = {e.ext: e for e in ALL}
 
     @staticmethod
     def from_ext(ext: str) -> Emulator | None:
@@ -124,7 +210,4 @@ class Emulators:
         :param ext: the extension of a game file
         :return: the emulator that should be used to run it
         """
-        for e in Emulators.ALL:
-            if e.ext == ext:
-                return e
-        return None
\ No newline at end of file
+        return Emulators._BY_EXT.get(ext)
\ No newline at end of file